@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import inspect
+
+import numpy as np
+import pytest
+import pyvisa
+
+from vna import VNA, AsyncVNA, _root
+
+
+class FakeInstr:
+    """Records the messages a VNA sends, answers every query with "1"."""
+
+    timeout = 2000
+    session = 0
+
+    def __init__(self):
+        self.log = []
+
+    def write(self, cmd):
+        self.log.append(("write", cmd))
+        return len(cmd)
+
+    def write_raw(self, data):
+        self.log.append(("write_raw", data))
+        return len(data)
+
+    def query(self, cmd):
+        self.log.append(("query", cmd))
+        return "1"
+
+    def query_binary_values(self, cmd, datatype="f", is_big_endian=False, container=list):
+        self.log.append(("query_binary", cmd, datatype, is_big_endian, container))
+        return np.zeros(4)
+
+    def query_ascii_values(self, cmd, converter="f"):
+        self.log.append(("query", cmd))
+        return [1.0 if converter == "f" else 1]
+
+    def flush(self, mask):
+        self.log.append(("flush", mask))
+
+    def close(self):
+        pass
+
+
+class FakeGPIBInstr(FakeInstr):
+    """Also records the service request handling of a GPIB resource."""
+
+    stb = 0x40
+
+    def wait_for_srq(self, timeout=25000):
+        raise AssertionError("the event must be enabled before the *OPC write")
+
+    def discard_events(self, event_type, mechanism):
+        self.log.append(("discard_events", event_type))
+
+    def enable_event(self, event_type, mechanism):
+        self.log.append(("enable_event", event_type))
+
+    def disable_event(self, event_type, mechanism):
+        self.log.append(("disable_event", event_type))
+
+    def wait_on_event(self, event_type, timeout):
+        self.log.append(("wait_on_event", event_type))
+
+
+class FakeLib:
+    def set_buffer(self, session, mask, size):
+        raise NotImplementedError
+
+
+class FakeRM:
+    visalib = FakeLib()
+
+    def open_resource(self, address, **kwargs):
+        return FakeInstr()
+
+
+@pytest.fixture
+def make_vna(monkeypatch):
+    monkeypatch.setattr(VNA, "_rm", FakeRM())
+    return lambda **kwargs: VNA("FAKE::INSTR", **kwargs)
+
+
+def queries(v):
+    return [cmd for kind, cmd in v._instr.log if kind == "query"]
+
+
+@pytest.mark.parametrize(
+    "cmd, root",
+    [
+        (":SENS1:FREQ:STAR 1E9", "SENS1"),
+        (":SENS1:BAND?", "SENS1"),
+        (":SOUR2:POW -10", "SOUR2"),
+        (":INIT1", "INIT1"),
+        ("*RST", "*RST"),
+        ("sens1:swe:poin?", "SENS1"),
+    ],
+)
+def test_root(cmd, root):
+    assert _root(cmd) == root
+
+
+def test_cache_answers_repeated_queries(make_vna):
+    v = make_vna(cache=True)
+    assert v.freq_start("?") == v.freq_start("?")
+    assert queries(v) == [":SENS1:FREQ:STAR?"]
+
+
+def test_cache_is_opt_in(make_vna):
+    v = make_vna()
+    v.power("?")
+    v.power("?")
+    assert len(queries(v)) == 2
+
+
+def test_write_invalidates_its_root_only(make_vna):
+    v = make_vna(cache=True)
+    v.freq_start("?")
+    v.power("?")
+    v.freq_center(1e9)
+    v.freq_start("?")
+    v.power("?")
+    assert queries(v) == [":SENS1:FREQ:STAR?", ":SOUR1:POW?", ":SENS1:FREQ:STAR?"]
+
+
+def test_compound_write_invalidates_every_root(make_vna):
+    v = make_vna(cache=True)
+    v.power("?")
+    v.bandwidth("?")
+    v.get_power(2)
+    v._send(":SOUR1:POW 0;:SENS1:BAND 10")
+    v.power("?")
+    v.bandwidth("?")
+    v.get_power(2)
+    assert queries(v) == [":SOUR1:POW?", ":SENS1:BAND?", ":SOUR2:POW?", ":SOUR1:POW?", ":SENS1:BAND?"]
+
+
+def test_rst_clears_cache(make_vna):
+    v = make_vna(cache=True)
+    v.power("?")
+    v.window_layout("?")
+    v._send("*CLS;*RST")
+    v.power("?")
+    v.window_layout("?")
+    assert len(queries(v)) == 4
+
+
+def test_no_cache(make_vna):
+    v = make_vna(cache=True)
+    v.power("?")
+    with v.no_cache():
+        v.power("?")
+    v.power("?")
+    assert len(queries(v)) == 2
+
+
+def test_batch_sends_one_compound_write(make_vna):
+    v = make_vna()
+    with v.batch():
+        v.freq_start(1e9)
+        v.freq_stop(2e9)
+        v.points(201)
+        assert v._instr.log == []
+    assert v._instr.log == [("write", ":SENS1:FREQ:STAR 1000000000.0;:SENS1:FREQ:STOP 2000000000.0;:SENS1:SWE:POIN 201")]
+
+
+def test_batch_flushes_before_query(make_vna):
+    v = make_vna()
+    with v.batch():
+        v.power(-10)
+        v.power("?")
+        v.points(11)
+    assert v._instr.log == [
+        ("write", ":SOUR1:POW -10"),
+        ("query", ":SOUR1:POW?"),
+        ("write", ":SENS1:SWE:POIN 11"),
+    ]
+
+
+def test_batch_discards_on_error(make_vna):
+    v = make_vna()
+    with pytest.raises(RuntimeError):
+        with v.batch():
+            v.power(-10)
+            raise RuntimeError
+    v.points(11)
+    assert v._instr.log == [("write", ":SENS1:SWE:POIN 11")]
+
+
+def test_nested_batch_joins_outer(make_vna):
+    v = make_vna()
+    with v.batch():
+        v.power(-10)
+        with v.batch():
+            v.points(11)
+        assert v._instr.log == []
+    assert v._instr.log == [("write", ":SOUR1:POW -10;:SENS1:SWE:POIN 11")]
+
+
+def test_invalid_mnemonic_is_not_sent(make_vna):
+    v = make_vna()
+    with pytest.raises(ValueError):
+        v.sweep_type("LINE")
+    with pytest.raises(ValueError):
+        v.window_layout(3)
+    with pytest.raises(ValueError):
+        v.sweep_type(None)
+    v.sweep_type("log")
+    assert v._instr.log == [("write", ":SENS1:SWE:TYPE LOG")]
+
+
+def test_cal_save_waits_for_measurement(make_vna):
+    v = make_vna()
+    v.cal_thru(1, 2, save=True)
+    assert v._instr.log == [
+        ("query", ":SENS1:CORR:COLL:THRU 1,2;:SENS1:CORR:COLL:THRU 2,1;*WAI;:SENS1:CORR:COLL:SAVE;*OPC?")
+    ]
+
+
+def test_open_many_closes_on_failure(monkeypatch, make_vna):
+    closed = []
+    monkeypatch.setattr(FakeInstr, "close", lambda self: closed.append(self))
+    opened = []
+
+    def open_resource(self, address, **kwargs):
+        if address == "BAD":
+            raise pyvisa.VisaIOError(-1073807343)
+        opened.append(FakeInstr())
+        return opened[-1]
+
+    monkeypatch.setattr(FakeRM, "open_resource", open_resource)
+    with pytest.raises(pyvisa.VisaIOError):
+        VNA.open_many(["A", "B", "BAD"])
+    assert closed == opened
+
+
+def test_trigger_raises_timeout_for_slow_sweeps(monkeypatch, make_vna):
+    v = make_vna()
+    monkeypatch.setattr(FakeInstr, "query_ascii_values", lambda self, cmd, converter="f": [10.0])
+    v.trigger()
+    assert v._instr.timeout == 20000
+    assert v._instr.log == [("write", ":INIT1")]
+
+
+def test_trigger_keeps_configured_timeout_as_floor(monkeypatch, make_vna):
+    v = make_vna()
+    v.timeout = 30000
+    monkeypatch.setattr(FakeInstr, "query_ascii_values", lambda self, cmd, converter="f": [0.1])
+    v.trigger()
+    assert v._instr.timeout == 30000
+
+
+def test_trigger_does_not_flush_batch(make_vna):
+    v = make_vna()
+    with v.batch():
+        v.power(-10)
+        v.trigger()
+    assert v._instr.log == [("write", ":SOUR1:POW -10;:INIT1")]
+
+
+def test_cal_on_gpib_waits_for_srq(make_vna):
+    v = make_vna()
+    v._instr = FakeGPIBInstr()
+    v.cal_open(1)
+    v.cal_shor(1)
+    srq = pyvisa.constants.EventType.service_request
+
+    def step(cmd):
+        return [
+            ("discard_events", srq),
+            ("enable_event", srq),
+            ("write", f"{cmd};*OPC"),
+            ("wait_on_event", srq),
+            ("query", "*ESR?"),
+            ("disable_event", srq),
+        ]
+
+    assert v._instr.log == (
+        [("query", "*ESE 1;*SRE 32;*ESR?")] + step(":SENS1:CORR:COLL:OPEN 1") + step(":SENS1:CORR:COLL:SHOR 1")
+    )
+
+
+def test_cal_without_srq_invalidates_cache(make_vna):
+    v = make_vna(cache=True)
+    v.power("?")
+    v.points("?")
+    v.cal_open(1)
+    v.power("?")
+    v.points("?")
+    assert queries(v) == [":SOUR1:POW?", ":SENS1:SWE:POIN?", ":SENS1:CORR:COLL:OPEN 1;*OPC?", ":SENS1:SWE:POIN?"]
+
+
+def test_limit_data_discards_stale_input_before_reading(make_vna):
+    v = make_vna(cache=True)
+    v.limit_data("?", 1)
+    v.limit_data("?", 1)
+    assert v._instr.log == [
+        ("flush", pyvisa.constants.BufferOperation.discard_read_buffer),
+        ("query", ":FORM:DATA ASC;:CALC1:TRAC1:LIM:DATA?"),
+    ]
+
+
+def test_flush_input_ignores_unsupported_backends(monkeypatch, make_vna):
+    v = make_vna()
+
+    def flush(self, mask):
+        raise NotImplementedError
+
+    monkeypatch.setattr(FakeInstr, "flush", flush)
+    v.calc_sdat_ascii(1)
+    assert v._instr.log == [("query", ":FORM:DATA ASC;:CALC1:TRAC1:DATA:SDAT?")]
+
+
+def test_async_vna_runs_methods_per_instrument(make_vna):
+    async def main():
+        vna1, vna2 = await asyncio.gather(
+            AsyncVNA.open("GPIB0::17::INSTR"), AsyncVNA.open("GPIB0::18::INSTR", cache=True)
+        )
+        results = await asyncio.gather(vna1.get_power(), vna2.set_points(201), vna1.points("?"))
+        return vna1, vna2, results
+
+    vna1, vna2, results = asyncio.run(main())
+    assert results == [1.0, None, 1]
+    assert vna1.vna._instr.log == [("query", ":SOUR1:POW?"), ("query", ":SENS1:SWE:POIN?")]
+    assert vna2.vna._instr.log == [("write", ":SENS1:SWE:POIN 201")]
+    assert vna2.vna._use_cache
+
+
+def test_async_vna_wraps_public_methods_only():
+    assert inspect.iscoroutinefunction(AsyncVNA.calc_fdat)
+    assert AsyncVNA.calc_fdat.__doc__ == VNA.calc_fdat.__doc__
+    for name in ("batch", "no_cache", "open_many", "_send"):
+        assert not hasattr(AsyncVNA, name)
+
+
+def test_freq_start_raw_write(make_vna):
+    v = make_vna(raw_writes=True)
+    v.freq_start(1e9)
+    v.set_freq_start(2.5e9, "2")
+    assert v._instr.log == [
+        ("write_raw", b":SENS1:FREQ:STAR 1000000000.0\n"),
+        ("write_raw", b":SENS2:FREQ:STAR 2500000000.0\n"),
+    ]
+
+
+def test_hot_setters_write_str_by_default(make_vna):
+    v = make_vna()
+    v.power(-10)
+    v.bandwidth(1e3, 2)
+    assert v._instr.log == [("write", ":SOUR1:POW -10"), ("write", ":SENS2:BAND 1000.0")]
+
+
+def test_raw_writes_fall_back_in_batch_and_with_cache(make_vna):
+    v = make_vna(cache=True, raw_writes=True)
+    v.points(201)
+    v.power("?")
+    v.power(-10)
+    with v.batch():
+        v.set_freq_span(1e6)
+        v.set_freq_center(2e9)
+    v.power("?")
+    assert v._instr.log == [
+        ("write_raw", b":SENS1:SWE:POIN 201\n"),
+        ("query", ":SOUR1:POW?"),
+        ("write", ":SOUR1:POW -10"),
+        ("write", ":SENS1:FREQ:SPAN 1000000.0;:SENS1:FREQ:CENT 2000000000.0"),
+        ("query", ":SOUR1:POW?"),
+    ]
+
+
+def test_trace_data_is_read_as_binary(make_vna):
+    v = make_vna()
+    data = v.calc_fdat(2, 3)
+    assert isinstance(data, np.ndarray)
+    assert v._instr.log[-1] == (
+        "query_binary",
+        ":FORM:DATA REAL;:FORM:BORD NORM;:CALC3:TRAC2:DATA:FDAT?",
+        "d",
+        True,
+        np.ndarray,
+    )
+
+
+def test_tables_are_sent_as_ascii_after_binary_reads(make_vna):
+    v = make_vna()
+    v.calc_sdat(1)
+    v.limit_data("1,2,1E9,2E9,-3,0", 1)
+    v.segm_data("?")
+    assert v._instr.log[-2:] == [
+        ("write", ":FORM:DATA ASC;:CALC1:TRAC1:LIM:DATA 1,2,1E9,2E9,-3,0"),
+        ("query", ":FORM:DATA ASC;:SENS1:SEGM:DATA?"),
+    ]
+
+
+def test_get_all_traces_reads_one_mfd_block(monkeypatch, make_vna):
+    v = make_vna()
+    log = []
+
+    def query_binary_values(self, cmd, **kwargs):
+        log.append(cmd)
+        return np.arange(12.0)
+
+    monkeypatch.setattr(FakeInstr, "query_binary_values", query_binary_values)
+    data = v.get_all_traces([1, 3], ch=2)
+    assert log == [":FORM:DATA REAL;:FORM:BORD NORM;:CALC2:TRAC:DATA:MFD? '1,3'"]
+    assert data.shape == (2, 3, 2)
+    assert data[1, 0].tolist() == [6.0, 7.0]
+
+
+def test_fast_mode_skips_completion_wait_until_sync(make_vna):
+    v = make_vna(fast=True)
+    v._instr = FakeGPIBInstr()
+    v.cal_open(1)
+    v.cal_thru(1, 2, bidirectional=False)
+    v.sync()
+    assert v._instr.log == [
+        ("write", ":SENS1:CORR:COLL:OPEN 1"),
+        ("write", ":SENS1:CORR:COLL:THRU 1,2"),
+        ("query", "*OPC?"),
+    ]
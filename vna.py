@@ -1,38 +1,387 @@
 # -*- coding: utf-8 -*-
-from typing import Union
-
+import asyncio
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, ClassVar, Dict, FrozenSet, Iterable, Iterator, List, Optional, Union
+
+import numpy as np
 import pyvisa as visa
 
 
-class VNA:
-    def __init__(self, address) -> None:
-        self._rm = visa.ResourceManager()
-        self._instr = self._rm.open_resource(address)
+# Pre-encoded commands for `VNA._send_raw`, formatted with (ch, value)
+_T_FREQ_STAR = b":SENS%d:FREQ:STAR %s"
+_T_FREQ_STOP = b":SENS%d:FREQ:STOP %s"
+_T_FREQ_CENT = b":SENS%d:FREQ:CENT %s"
+_T_FREQ_SPAN = b":SENS%d:FREQ:SPAN %s"
+_T_POW = b":SOUR%d:POW %s"
+_T_SWE_POIN = b":SENS%d:SWE:POIN %s"
+_T_BAND = b":SENS%d:BAND %s"
+
+
+# VISA event used to wait for *OPC on GPIB
+_SRQ = visa.constants.EventType.service_request
+_QUEUE = visa.constants.EventMechanism.queue
+
+
+# Accepted mnemonics (short and long form, upper case)
+_VALID_SWEEP = frozenset({"LIN", "LINEAR", "LOG", "LOGARITHMIC", "SEGM", "SEGMENT", "POW", "POWER"})
+_VALID_LAYOUT = frozenset(
+    {
+        "D1", "D12", "D1_2", "D112", "D1_1_2", "D123", "D1_2_3", "D12_33", "D11_23", "D13_23", "D12_13",
+        "D1234", "D1_2_3_4", "D12_34", "D123_456", "D12_34_56", "D1234_5678", "D12_34_56_78",
+        "D123_456_789", "D1234_5678_9ABC", "D1234_5678_9ABC_DEFG",
+    }
+)
+_VALID_FORMAT = frozenset(
+    {
+        "MLOG", "MLOGARITHMIC", "PHAS", "PHASE", "GDEL", "GDELAY", "SLIN", "SLINEAR", "SLOG", "SLOGARITHMIC",
+        "SCOM", "SCOMPLEX", "SMIT", "SMITH", "SADM", "SADMITTANCE", "PLIN", "PLINEAR", "PLOG", "PLOGARITHMIC",
+        "POL", "POLAR", "MLIN", "MLINEAR", "SWR", "REAL", "IMAG", "IMAGINARY", "UPH", "UPHASE", "PPH", "PPHASE",
+    }
+)
+_VALID_PARAMETER = frozenset(f"S{i}{j}" for i in range(1, 5) for j in range(1, 5))
+_VALID_SAVE_TYPE = frozenset({"STAT", "STATE", "CST", "CSTATE", "DST", "DSTATE", "CDST", "CDSTATE"})
+
+
+def _choice(value: str, valid: FrozenSet[str], name: str) -> str:
+    """Returns value in upper case if it is one of the valid mnemonics, raises ValueError otherwise."""
+    mnemonic = str(value).upper()
+    if mnemonic not in valid:
+        raise ValueError(f"invalid {name} {value!r}, expected one of: {', '.join(sorted(valid))}")
+    return mnemonic
+
+
+def _locked(method):
+    """Runs the method while holding the instrument lock."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
 
+def _root(cmd: str) -> str:
+    """Returns the root node of a SCPI command, eg. 'SENS1' for ':SENS1:FREQ:STAR 1E9'."""
+    return cmd.lstrip(":").split(":", 1)[0].split(" ", 1)[0].rstrip("?").upper()
+
+
+class VNA:
+    """Driver of a vector network analyzer such as the E5071C.
+
+    An instance may be shared between threads: every access to the instrument holds a per-instrument lock.
+    All instances share one VISA resource manager.
+    """
+
+    _rm: ClassVar[Optional[visa.ResourceManager]] = None
+    _rm_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __init__(
+        self,
+        address,
+        cache: bool = False,
+        fast: bool = False,
+        raw_writes: bool = False,
+        read_termination: str = "\n",
+        write_termination: str = "\n",
+        send_end: bool = True,
+        chunk_size: int = 1 << 20,
+        buffer_size: int = 1 << 20,
+    ) -> None:
+        """
+        Parameters
+        ----------
+        address: str
+            VISA resource name, eg. 'GPIB0::17::INSTR'
+        cache: bool
+            Remember the answers of setting queries (freq_start('?'), points('?'), ...) until a command
+            under the same SCPI root node (eg. ':SENS1') is written. Only enable it when nothing else
+            changes the instrument settings, see `invalidate` and `no_cache`.
+        fast: bool
+            Do not wait for calibration steps to complete, the instrument queues the following commands.
+            Call `sync` before reading results. Use with care: sending commands faster than the
+            instrument executes them can overrun its input queue. Can be changed later via `vna.fast`.
+        raw_writes: bool
+            Send the frequency, power, points and bandwidth settings as pre-encoded bytes with write_raw.
+            Saves some Python overhead per call on fast links (TCPIP, USBTMC), negligible on GPIB.
+        read_termination, write_termination: str
+            Message terminators, the E5071C uses '\\n' in both directions.
+        send_end: bool
+            Assert EOI with the last byte of each write.
+        chunk_size: int
+            Bytes requested per VISA read, large enough for a full trace in one read.
+        buffer_size: int
+            Size of the VISA input buffer, if the VISA library supports setting it.
+        """
+        self._lock = threading.RLock()
+        with VNA._rm_lock:
+            if VNA._rm is None:
+                VNA._rm = visa.ResourceManager()
+            self._rm = VNA._rm
+        self._instr = self._rm.open_resource(
+            address,
+            read_termination=read_termination,
+            write_termination=write_termination,
+            send_end=send_end,
+            chunk_size=chunk_size,
+        )
+        try:
+            self._rm.visalib.set_buffer(self._instr.session, visa.constants.VI_IO_IN_BUF, buffer_size)
+        except (NotImplementedError, visa.VisaIOError):
+            pass
+        self._write_term = write_termination.encode()
+        self._base_timeout = self._instr.timeout
+        self.fast = fast
+        self.raw_writes = raw_writes
+        self._srq_enabled = False
+        self._buffer: Optional[List[str]] = None
+        self._use_cache = cache
+        self._qcache: Dict[str, Dict[str, Any]] = {}
+
+    @classmethod
+    def open_many(cls, addresses: Iterable[str], **kwargs) -> List["VNA"]:
+        """Connects to several instruments, kwargs are passed to each `VNA`.
+
+        If one connection fails, the instruments opened so far are closed again.
+
+        Examples
+        --------
+        >>> vna1, vna2 = VNA.open_many(["GPIB0::17::INSTR", "GPIB0::18::INSTR"], cache=True)
+        """
+        vnas: List["VNA"] = []
+        try:
+            for address in addresses:
+                vnas.append(cls(address, **kwargs))
+        except BaseException:
+            for vna in vnas:
+                vna.close()
+            raise
+        return vnas
+
+    @_locked
     def close(self) -> None:
         """Disconnect the instrument."""
         self._instr.close()
         self._instr = None
 
+    @property
+    def timeout(self) -> float:
+        """VISA timeout in ms, the lower bound of the timeout `trigger` derives from the sweep time."""
+        return self._base_timeout
+
+    @timeout.setter
+    def timeout(self, timeout: float) -> None:
+        with self._lock:
+            self._base_timeout = self._instr.timeout = timeout
+
+    def sync(self) -> None:
+        """Blocks until the instrument has completed all pending operations (*OPC?)."""
+        self._ask("*OPC?")
+
+    ####################
+    # I/O
+    ####################
+    @_locked
+    def _send(self, cmd: str) -> Optional[int]:
+        """Writes cmd, or queues it while inside a `batch` block."""
+        if self._qcache:
+            self._invalidate(cmd)
+        if self._buffer is not None:
+            self._buffer.append(cmd)
+            return None
+        return self._instr.write(cmd)
+
+    @_locked
+    def _send_raw(self, template: bytes, ch: int, value: Union[float, str]) -> Optional[int]:
+        """Writes a pre-encoded command template with write_raw, skipping PyVISA's string encoding.
+
+        Used by the setters when `raw_writes` is set. Goes through `_send` when the command has to be
+        queued or checked against the query cache.
+        """
+        if self._buffer is not None or self._qcache:
+            return self._send(template.decode() % (int(ch), value))
+        return self._instr.write_raw(template % (int(ch), str(value).encode()) + self._write_term)
+
+    @_locked
+    def _ask(self, cmd: str) -> str:
+        """Sends any queued commands, then queries cmd."""
+        self._flush_batch()
+        return self._instr.query(cmd)
+
+    @_locked
+    def _ask_trace(self, cmd: str) -> np.ndarray:
+        """Queries trace data as an IEEE 488.2 block of 64-bit big-endian floats.
+
+        The data format is set in the same message, so no extra round trip is needed. It stays REAL afterwards,
+        which also applies to the limit and segment tables, so those set ASCII in their own messages.
+        """
+        self._flush_batch()
+        self._flush_input()
+        return self._instr.query_binary_values(
+            f":FORM:DATA REAL;:FORM:BORD NORM;{cmd}", datatype="d", is_big_endian=True, container=np.ndarray
+        )
+
+    def _flush_input(self) -> None:
+        """Discards bytes left in VISA's formatted I/O read buffer.
+
+        A stale reply still in the instrument's output queue, eg. after a timeout, is not affected.
+        """
+        try:
+            self._instr.flush(visa.constants.BufferOperation.discard_read_buffer)
+        except (NotImplementedError, visa.VisaIOError):
+            pass
+
+    @_locked
+    def _ask_value(self, cmd: str, converter: Optional[str] = None, flush_input: bool = False) -> Any:
+        """Queries cmd, returning the answer as str or, with a query_ascii_values converter ('f', 'd'), its first value.
+
+        With flush_input, the VISA read buffer is discarded right before the query.
+        """
+        if flush_input:
+            self._flush_input()
+        if converter is None:
+            return self._ask(cmd)
+        self._flush_batch()
+        return self._instr.query_ascii_values(cmd, converter=converter)[0]
+
+    @_locked
+    def _ask_cached(self, cmd: str, converter: Optional[str] = None, flush_input: bool = False) -> Any:
+        """Like `_ask_value`, answering from the query cache when it is enabled."""
+        if not self._use_cache:
+            return self._ask_value(cmd, converter, flush_input)
+        entries = self._qcache.setdefault(_root(cmd.rsplit(";", 1)[-1]), {})
+        if cmd not in entries:
+            entries[cmd] = self._ask_value(cmd, converter, flush_input)
+        return entries[cmd]
+
+    def _q_float(self, cmd: str) -> float:
+        return self._ask_cached(cmd, "f")
+
+    def _q_int(self, cmd: str) -> int:
+        return self._ask_cached(cmd, "d")
+
+    def _invalidate(self, cmd: str) -> None:
+        """Drops the cached queries that the written cmd may have changed."""
+        for part in cmd.split(";"):
+            root = _root(part)
+            if root in ("*RST", "*RCL"):
+                self._qcache.clear()
+                return
+            self._qcache.pop(root, None)
+
+    @_locked
+    def invalidate(self) -> None:
+        """Clears the query cache, eg. after the instrument was changed from its front panel."""
+        self._qcache.clear()
+
+    @contextmanager
+    def no_cache(self) -> Iterator["VNA"]:
+        """Bypasses the query cache inside the block."""
+        with self._lock:
+            use_cache, self._use_cache = self._use_cache, False
+            try:
+                yield self
+            finally:
+                self._use_cache = use_cache
+
+    @_locked
+    def _write_opc(self, cmd: str) -> None:
+        """Writes cmd and blocks until the instrument has completed it.
+
+        On GPIB the command is followed by *OPC and the operation complete service request is awaited,
+        so no read is pending while the instrument works. Other interfaces append *OPC? to the same message.
+        In `fast` mode cmd is only written.
+        """
+        if self.fast:
+            self._send(cmd)
+        elif hasattr(self._instr, "wait_for_srq"):
+            if not self._srq_enabled:
+                # Route the OPC event to SRQ and clear a stale one
+                self._ask("*ESE 1;*SRE 32;*ESR?")
+                self._srq_enabled = True
+            self._instr.discard_events(_SRQ, _QUEUE)
+            self._instr.enable_event(_SRQ, _QUEUE)
+            try:
+                self._send(f"{cmd};*OPC")
+                self._opc_wait()
+            finally:
+                self._instr.disable_event(_SRQ, _QUEUE)
+        else:
+            if self._qcache:
+                self._invalidate(cmd)
+            self._ask(f"{cmd};*OPC?")
+
+    def _opc_wait(self) -> None:
+        """Waits for the service request raised by a preceding *OPC, then clears the event status register.
+
+        The service request event must be enabled before the *OPC is written.
+        """
+        self._flush_batch()
+        timeout = self._instr.timeout
+        deadline = None if timeout == float("inf") else time.perf_counter() + timeout / 1000
+        while True:
+            if deadline is None:
+                remaining = visa.constants.VI_TMO_INFINITE
+            else:
+                remaining = max(0, int((deadline - time.perf_counter()) * 1000))
+            self._instr.wait_on_event(_SRQ, remaining)
+            if self._instr.stb & 0x40:
+                break
+        self._instr.query("*ESR?")
+
+    def _flush_batch(self) -> None:
+        if self._buffer:
+            cmds, self._buffer = self._buffer, []
+            self._instr.write(";".join(cmds))
+
+    @contextmanager
+    def batch(self) -> Iterator["VNA"]:
+        """Collects the commands written inside the block and sends them as one compound SCPI command.
+
+        Queries inside the block send the pending commands first. Nothing queued is sent if the block raises.
+        Other threads using this instrument wait until the block is left.
+
+        Examples
+        --------
+        >>> with vna.batch():
+        ...     vna.freq_start(1e9)
+        ...     vna.freq_stop(2e9)
+        ...     vna.points(1601)
+        """
+        with self._lock:
+            if self._buffer is not None:
+                yield self
+                return
+            self._buffer = []
+            try:
+                yield self
+                self._flush_batch()
+            finally:
+                self._buffer = None
+
     ####################
     # ACTIVE CH/TRACE
     ####################
     def active_channel(self, ch: int = 1) -> None:
         """Specifies selected channel (Ch) as the active channel."""
-        self._instr.write(f":DISP:WIND{ch}:ACT")
+        self._send(f":DISP:WIND{ch}:ACT")
 
     def active_trace(self, tr: int, ch: int = 1) -> None:
         """Sets/gets the selected trace(Tr) of selected channel(Ch) to the active trace."""
-        self._instr.write(f":CALC{ch}:PAR{tr}:SEL")
+        self._send(f":CALC{ch}:PAR{tr}:SEL")
 
     def trace_number(self, num: int, ch: int = 1) -> None:
         """Sets/gets the number of traces of selected channel(Ch)."""
-        self._instr.write(f":CALC{ch}:PAR:COUN {num}")
+        self._send(f":CALC{ch}:PAR:COUN {num}")
 
     ####################
     # Frequency
     ####################
-    def freq_start(self, freq: Union[float, str], ch: int = 1) -> str:
+    def freq_start(self, freq: Union[float, str], ch: int = 1) -> Optional[float]:
         """Sets/gets the start value of the sweep range of selected channel(Ch).
 
         Parameters
@@ -42,11 +391,22 @@ class VNA:
             Set the start value if freq is a float number, the unit is Hz(hertz).
         """
         if isinstance(freq, str) and freq == "?":
-            return self._instr.query(f":SENS{ch}:FREQ:STAR?")
+            return self.get_freq_start(ch)
+        else:
+            return self.set_freq_start(freq, ch)
+
+    def get_freq_start(self, ch: int = 1) -> float:
+        """Gets the start value of the sweep range of selected channel(Ch), the unit is Hz(hertz)."""
+        return self._q_float(f":SENS{ch}:FREQ:STAR?")
+
+    def set_freq_start(self, freq: float, ch: int = 1) -> None:
+        """Sets the start value of the sweep range of selected channel(Ch), the unit is Hz(hertz)."""
+        if self.raw_writes:
+            self._send_raw(_T_FREQ_STAR, ch, freq)
         else:
-            return self._instr.write(f":SENS{ch}:FREQ:STAR {freq}")
+            self._send(f":SENS{ch}:FREQ:STAR {freq}")
 
-    def freq_stop(self, freq: Union[float, str], ch: int = 1) -> str:
+    def freq_stop(self, freq: Union[float, str], ch: int = 1) -> Optional[float]:
         """Sets/gets the stop value of the sweep range of selected channel(Ch).
 
         Parameters
@@ -56,11 +416,22 @@ class VNA:
             Set the stop value if freq is a float number, the unit is Hz(hertz).
         """
         if isinstance(freq, str) and freq == "?":
-            return self._instr.query(f":SENS{ch}:FREQ:STAR?")
+            return self.get_freq_stop(ch)
         else:
-            return self._instr.write(f":SENS{ch}:FREQ:STOP {freq}")
+            return self.set_freq_stop(freq, ch)
 
-    def freq_center(self, freq: Union[float, str], ch: int = 1) -> str:
+    def get_freq_stop(self, ch: int = 1) -> float:
+        """Gets the stop value of the sweep range of selected channel(Ch), the unit is Hz(hertz)."""
+        return self._q_float(f":SENS{ch}:FREQ:STOP?")
+
+    def set_freq_stop(self, freq: float, ch: int = 1) -> None:
+        """Sets the stop value of the sweep range of selected channel(Ch), the unit is Hz(hertz)."""
+        if self.raw_writes:
+            self._send_raw(_T_FREQ_STOP, ch, freq)
+        else:
+            self._send(f":SENS{ch}:FREQ:STOP {freq}")
+
+    def freq_center(self, freq: Union[float, str], ch: int = 1) -> Optional[float]:
         """Sets/gets the center value of the sweep range of selected channel(Ch).
 
         Parameters
@@ -70,11 +441,22 @@ class VNA:
             Set the center value if freq is a float number, the unit is Hz(hertz).
         """
         if isinstance(freq, str) and freq == "?":
-            return self._instr.query(f":SENS{ch}:FREQ:CENT?")
+            return self.get_freq_center(ch)
+        else:
+            return self.set_freq_center(freq, ch)
+
+    def get_freq_center(self, ch: int = 1) -> float:
+        """Gets the center value of the sweep range of selected channel(Ch), the unit is Hz(hertz)."""
+        return self._q_float(f":SENS{ch}:FREQ:CENT?")
+
+    def set_freq_center(self, freq: float, ch: int = 1) -> None:
+        """Sets the center value of the sweep range of selected channel(Ch), the unit is Hz(hertz)."""
+        if self.raw_writes:
+            self._send_raw(_T_FREQ_CENT, ch, freq)
         else:
-            return self._instr.write(f":SENS{ch}:FREQ:CENT {freq}")
+            self._send(f":SENS{ch}:FREQ:CENT {freq}")
 
-    def freq_span(self, freq: Union[float, str], ch: int = 1) -> str:
+    def freq_span(self, freq: Union[float, str], ch: int = 1) -> Optional[float]:
         """Sets/gets the span value of the sweep range of selected channel(Ch).
 
         Parameters
@@ -84,14 +466,25 @@ class VNA:
             Set the span value if freq is a float number, the unit is Hz(hertz).
         """
         if isinstance(freq, str) and freq == "?":
-            return self._instr.query(f":SENS1:FREQ:SPAN?")
+            return self.get_freq_span(ch)
         else:
-            return self._instr.write(f":SENS{ch}:FREQ:SPAN {freq}")
+            return self.set_freq_span(freq, ch)
+
+    def get_freq_span(self, ch: int = 1) -> float:
+        """Gets the span value of the sweep range of selected channel(Ch), the unit is Hz(hertz)."""
+        return self._q_float(f":SENS{ch}:FREQ:SPAN?")
+
+    def set_freq_span(self, freq: float, ch: int = 1) -> None:
+        """Sets the span value of the sweep range of selected channel(Ch), the unit is Hz(hertz)."""
+        if self.raw_writes:
+            self._send_raw(_T_FREQ_SPAN, ch, freq)
+        else:
+            self._send(f":SENS{ch}:FREQ:SPAN {freq}")
 
     ####################
     # Sweep Setup
     ####################
-    def power(self, power: Union[float, str], ch: int = 1) -> str:
+    def power(self, power: Union[float, str], ch: int = 1) -> Optional[float]:
         """Sets/gets the power level of the selected channel(Ch).
 
         Parameters
@@ -101,11 +494,22 @@ class VNA:
             Set the power level if power is a float number, the unit is dBm.
         """
         if isinstance(power, str) and power == "?":
-            return self._instr.query(f":SOUR{ch}:POW?")
+            return self.get_power(ch)
         else:
-            return self._instr.write(f":SOUR{ch}:POW {power}")
+            return self.set_power(power, ch)
+
+    def get_power(self, ch: int = 1) -> float:
+        """Gets the power level of selected channel(Ch), the unit is dBm."""
+        return self._q_float(f":SOUR{ch}:POW?")
 
-    def points(self, point: Union[int, str], ch: int = 1) -> str:
+    def set_power(self, power: float, ch: int = 1) -> None:
+        """Sets the power level of selected channel(Ch), the unit is dBm."""
+        if self.raw_writes:
+            self._send_raw(_T_POW, ch, power)
+        else:
+            self._send(f":SOUR{ch}:POW {power}")
+
+    def points(self, point: Union[int, str], ch: int = 1) -> Optional[int]:
         """Sets/gets the number of measurement points of selected channel(Ch).
 
         Parameters
@@ -115,9 +519,20 @@ class VNA:
             Set the points if point is a int number.
         """
         if isinstance(point, str) and point == "?":
-            return self._instr.query(f":SENS{ch}:SWE:POIN?")
+            return self.get_points(ch)
         else:
-            return self._instr.write(f":SENS{ch}:SWE:POIN {point}")
+            return self.set_points(point, ch)
+
+    def get_points(self, ch: int = 1) -> int:
+        """Gets the number of measurement points of selected channel(Ch)."""
+        return self._q_int(f":SENS{ch}:SWE:POIN?")
+
+    def set_points(self, point: int, ch: int = 1) -> None:
+        """Sets the number of measurement points of selected channel(Ch)."""
+        if self.raw_writes:
+            self._send_raw(_T_SWE_POIN, ch, point)
+        else:
+            self._send(f":SENS{ch}:SWE:POIN {point}")
 
     def sweep_type(self, typ: str, ch: int = 1) -> str:
         """Sets/gets the sweep type of selected channel(Ch).
@@ -133,9 +548,10 @@ class VNA:
             - "POWer": Sets the sweep type to the power sweep.
         """
         if typ == "?":
-            return self._instr.query(f":SENS{ch}:SWE:TYPE?")
+            return self._ask_cached(f":SENS{ch}:SWE:TYPE?")
         else:
-            return self._instr.write(f":SENS{ch}:SWE:TYPE {typ}")
+            typ = _choice(typ, _VALID_SWEEP, "sweep type")
+            return self._send(f":SENS{ch}:SWE:TYPE {typ}")
 
     def segm_data(self, data: str, ch=1) -> str:
         """Creates the segment sweep table of selected channel(Ch).
@@ -146,14 +562,14 @@ class VNA:
             See: https://rfmw.em.keysight.com/wireless/helpfiles/e5071c/programming/command_reference/sense/scpi_sense_ch_segment_data.htm
         """
         if data == "?":
-            return self._instr.query(f":SENS{ch}:SEGM:DATA?")
+            return self._ask_cached(f":FORM:DATA ASC;:SENS{ch}:SEGM:DATA?")
         else:
-            return self._instr.write(f":SENS{ch}:SEGM:DATA {data}")
+            return self._send(f":FORM:DATA ASC;:SENS{ch}:SEGM:DATA {data}")
 
     ####################
     # RESPONSE
     ####################
-    def bandwidth(self, bw: Union[float, str], ch: int = 1) -> str:
+    def bandwidth(self, bw: Union[float, str], ch: int = 1) -> Optional[float]:
         """Sets/gets the IF bandwidth of selected channel(Ch).
 
         Parameters
@@ -163,11 +579,22 @@ class VNA:
             Set the IF bandwidth if bw is a float number.
         """
         if isinstance(bw, str) and bw == "?":
-            return self._instr.query(f":SENS{ch}:BAND?")
+            return self.get_bandwidth(ch)
+        else:
+            return self.set_bandwidth(bw, ch)
+
+    def get_bandwidth(self, ch: int = 1) -> float:
+        """Gets the IF bandwidth of selected channel(Ch)."""
+        return self._q_float(f":SENS{ch}:BAND?")
+
+    def set_bandwidth(self, bw: float, ch: int = 1) -> None:
+        """Sets the IF bandwidth of selected channel(Ch)."""
+        if self.raw_writes:
+            self._send_raw(_T_BAND, ch, bw)
         else:
-            return self._instr.write(f":SENS{ch}:BAND {bw}")
+            self._send(f":SENS{ch}:BAND {bw}")
 
-    def trace_num(self, num: Union[int, str], ch: int = 1) -> str:
+    def trace_num(self, num: Union[int, str], ch: int = 1) -> Optional[int]:
         """Sets/gets the number of traces of selected channel(Ch).
 
         Parameters
@@ -177,9 +604,17 @@ class VNA:
             Set the number of traces if num is a int number.
         """
         if isinstance(num, str) and num == "?":
-            return self._instr.query(f":CALC{ch}:PAR:COUN?")
+            return self.get_trace_num(ch)
         else:
-            return self._instr.write(f":CALC{ch}:PAR:COUN {num}")
+            return self.set_trace_num(num, ch)
+
+    def get_trace_num(self, ch: int = 1) -> int:
+        """Gets the number of traces of selected channel(Ch)."""
+        return self._q_int(f":CALC{ch}:PAR:COUN?")
+
+    def set_trace_num(self, num: int, ch: int = 1) -> None:
+        """Sets the number of traces of selected channel(Ch)."""
+        self._send(f":CALC{ch}:PAR:COUN {num}")
 
     def window_layout(self, layout: str, ch: int = 1) -> str:
         """Sets/gets the graph layout of selected channel(Ch).
@@ -190,9 +625,10 @@ class VNA:
             See: https://rfmw.em.keysight.com/wireless/helpfiles/e5071c/programming/command_reference/display/scpi_display_window_ch_split.htm
         """
         if layout == "?":
-            return self._instr.query(":DISP:WIND{ch}:SPL?")
+            return self._ask_cached(f":DISP:WIND{ch}:SPL?")
         else:
-            return self._instr.write(f":DISP:WIND{ch}:SPL {layout}")
+            layout = _choice(layout, _VALID_LAYOUT, "window layout")
+            return self._send(f":DISP:WIND{ch}:SPL {layout}")
 
     def parameter(self, para: str, tr: int, ch: int = 1) -> str:
         """Sets/gets the measurement parameter of the selected trace(Tr), for the selected channel(Ch).
@@ -203,9 +639,10 @@ class VNA:
             See: https://rfmw.em.keysight.com/wireless/helpfiles/e5071c/programming/command_reference/calculate/scpi_calculate_ch_parameter_tr_define.htm
         """
         if para == "?":
-            return self._instr.query(f":CALC{ch}:PAR{tr}:DEF?")
+            return self._ask_cached(f":CALC{ch}:PAR{tr}:DEF?")
         else:
-            return self._instr.write(f":CALC{ch}:PAR{tr}:DEF {para}")
+            para = _choice(para, _VALID_PARAMETER, "parameter")
+            return self._send(f":CALC{ch}:PAR{tr}:DEF {para}")
 
     def format(self, form: str, tr: int, ch: int = 1) -> str:
         """Sets/gets the data format of the active trace of selected channel(Ch).
@@ -216,9 +653,10 @@ class VNA:
             See: https://rfmw.em.keysight.com/wireless/helpfiles/e5071c/programming/command_reference/calculate/scpi_calculate_ch_selected_format.htm
         """
         if form == "?":
-            return self._instr.query(f":CALC{ch}:TRAC{tr}:FORM?")
+            return self._ask_cached(f":CALC{ch}:TRAC{tr}:FORM?")
         else:
-            return self._instr.write(f":CALC{ch}:TRAC{tr}:FORM {form}")
+            form = _choice(form, _VALID_FORMAT, "format")
+            return self._send(f":CALC{ch}:TRAC{tr}:FORM {form}")
 
     ####################
     # Calibration
@@ -233,9 +671,9 @@ class VNA:
             Sets the calibration kit if kit is a integer.
         """
         if kit == "?":
-            return self._instr.query(f":SENS{ch}:CORR:COLL:CKIT?")
+            return self._ask_cached(f":SENS{ch}:CORR:COLL:CKIT?")
         else:
-            return self._instr.write(f":SENS{ch}:CORR:COLL:CKIT {kit}")
+            return self._send(f":SENS{ch}:CORR:COLL:CKIT {kit}")
 
     def cal_meth(self, ports: str, ch: int = 1) -> str:
         """Sets the calibration type to the full 2-port calibration between the specified 2 ports, for the selected channel(Ch).
@@ -245,7 +683,7 @@ class VNA:
         ports: str
             Specifies the port for full 2-port calibration. eg. 1,2
         """
-        return self._instr.write(f":SENS{ch}:CORR:COLL:METH:SOLT2 {ports}")
+        return self._send(f":SENS{ch}:CORR:COLL:METH:SOLT2 {ports}")
 
     def cal_open(self, port: int, ch: int = 1) -> None:
         """Measures the calibration data of the open standard for the specified port, for the selected channel(Ch).
@@ -255,8 +693,7 @@ class VNA:
         port: int
             the specified port
         """
-        self._instr.write(f":SENS{ch}:CORR:COLL:OPEN {port}")
-        self._instr.query("*OPC?")
+        self._write_opc(f":SENS{ch}:CORR:COLL:OPEN {port}")
 
     def cal_shor(self, port: int, ch: int = 1) -> None:
         """Measures the calibration data of the short standard for the specified port, for the selected channel(Ch).
@@ -266,32 +703,55 @@ class VNA:
         port: int
             the specified port
         """
-        self._instr.write(f":SENS{ch}:CORR:COLL:SHOR {port}")
-        self._instr.query("*OPC?")
+        self._write_opc(f":SENS{ch}:CORR:COLL:SHOR {port}")
 
-    def cal_load(self, port: int, ch: int = 1) -> None:
+    def cal_load(self, port: int, ch: int = 1, save: bool = False) -> None:
         """Measures the calibration data of the load standard for the specified port, for the selected channel(Ch).
 
         Parameters
         ----------
         port: int
             the specified port
+        save: bool
+            Calculate and turn on the calibration in the same command when this is the last step, see `cal_done`.
+            A *WAI before the save makes it wait for the measurement to finish.
         """
-        self._instr.write(f":SENS{ch}:CORR:COLL:LOAD {port}")
-        self._instr.query("*OPC?")
+        cmd = f":SENS{ch}:CORR:COLL:LOAD {port}"
+        if save:
+            cmd += f";*WAI;:SENS{ch}:CORR:COLL:SAVE"
+        self._write_opc(cmd)
 
     def cal(self, typ: str, port: int, ch: int = 1) -> None:
-        self._instr.write(f":SENS{ch}:CORR:COLL:{typ} {port}")
-        self._instr.query("*OPC?")
+        self._write_opc(f":SENS{ch}:CORR:COLL:{typ} {port}")
+
+    def cal_thru(self, port1: int, port2: int, ch: int = 1, bidirectional: bool = True, save: bool = False) -> None:
+        """Measures the calibration data of the Thru standard from the specified stimulus port to the specified response port, for the selected channel(Ch).
 
-    def cal_thru(self, port1: int, port2: int, ch: int = 1) -> None:
-        """Measures the calibration data of the Thru standard from the specified stimulus port to the specified response port, for the selected channel(Ch)."""
-        self._instr.write(f":SENS{ch}:CORR:COLL:THRU {port1},{port2}")
-        self._instr.write(f":SENS{ch}:CORR:COLL:THRU {port2},{port1}")
-        self._instr.query("*OPC?")
+        Parameters
+        ----------
+        port1: int
+            the stimulus port
+        port2: int
+            the response port
+        bidirectional: bool
+            Also measure from port2 to port1 in the same command, as the full 2-port calibration requires.
+        save: bool
+            Calculate and turn on the calibration in the same command when this is the last step, see `cal_done`.
+            A *WAI before the save makes it wait for the measurement to finish.
+        """
+        cmd = f":SENS{ch}:CORR:COLL:THRU {port1},{port2}"
+        if bidirectional:
+            cmd += f";:SENS{ch}:CORR:COLL:THRU {port2},{port1}"
+        if save:
+            cmd += f";*WAI;:SENS{ch}:CORR:COLL:SAVE"
+        self._write_opc(cmd)
 
     def cal_done(self, ch: int = 1) -> None:
-        self._instr.write(f":SENS{ch}:CORR:COLL:SAVE")
+        """Calculates the calibration coefficients from the measured standards and turns on the error correction.
+
+        Not needed if the last `cal_load`/`cal_thru` was called with save=True.
+        """
+        self._send(f":SENS{ch}:CORR:COLL:SAVE")
 
     ####################
     # Save/Recall
@@ -301,12 +761,13 @@ class VNA:
         See: https://rfmw.em.keysight.com/wireless/helpfiles/e5071c/programming/command_reference/memory/scpi_mmemory_store_stype.htm
         """
         if stype == "?":
-            return self._instr.query(":MMEM:STOR:STYP?")
+            return self._ask_cached(":MMEM:STOR:STYP?")
         else:
-            return self._instr.write(f":MMEM:STOR:STYP {stype}")
+            stype = _choice(stype, _VALID_SAVE_TYPE, "save type")
+            return self._send(f":MMEM:STOR:STYP {stype}")
 
     def mdir(self, folder: str) -> None:
-        self._instr.write(f":MMEM:MDIR '{folder}'")
+        self._send(f":MMEM:MDIR '{folder}'")
 
     def stor_stat(self, file: str) -> None:
         """Saves the instrument state into a file(file with the .sta extension).
@@ -317,7 +778,7 @@ class VNA:
             File name to save the instrument state (extension ".sta")
             eg. 'D:/FILTERS/test.sta'
         """
-        self._instr.write(f":MMEM:STOR '{file}'")
+        self._send(f":MMEM:STOR '{file}'")
 
     def load_stat(self, file: str) -> None:
         """This command recalls the specified instrument state file.
@@ -328,29 +789,72 @@ class VNA:
             File name of instrument state (extension ".sta")
             eg. 'D:/FILTERS/test.sta'
         """
-        self._instr.write(f":MMEM:LOAD '{file}'")
+        self._send(f":MMEM:LOAD '{file}'")
+        self.invalidate()
 
     ####################
     # CALCULATE
     ####################
-    def calc_sdat(self, tr: int, ch: int = 1) -> str:
-        """Gets the corrected data array, for the active trace of selected channel(Ch)."""
-        return self._instr.query(f":CALC{ch}:TRAC{tr}:DATA:SDAT?")
+    def calc_sdat(self, tr: int, ch: int = 1) -> np.ndarray:
+        """Gets the corrected data array, for the active trace of selected channel(Ch).
+
+        The data is transferred in binary, use `calc_sdat_ascii` if the connection does not support it.
+        """
+        return self._ask_trace(f":CALC{ch}:TRAC{tr}:DATA:SDAT?")
 
-    def calc_fdat(self, tr: int, ch: int = 1) -> str:
+    def calc_sdat_ascii(self, tr: int, ch: int = 1) -> str:
+        """Gets the corrected data array as ASCII text, for the active trace of selected channel(Ch)."""
+        with self._lock:
+            self._flush_input()
+            return self._ask(f":FORM:DATA ASC;:CALC{ch}:TRAC{tr}:DATA:SDAT?")
+
+    def calc_fdat(self, tr: int, ch: int = 1) -> np.ndarray:
         """Gets the formatted data array, for the active trace of selected channel(Ch)."""
-        return self._instr.query(f":CALC{ch}:TRAC{tr}:DATA:FDAT?")
+        return self._ask_trace(f":CALC{ch}:TRAC{tr}:DATA:FDAT?")
 
-    def calc_mfd(self, trs: str, ch: int = 1) -> str:
+    def calc_mfd(self, trs: str, ch: int = 1) -> np.ndarray:
         """Gets the formatted data array of multiple traces of the selected channel(Ch)."""
-        return self._instr.query(f":CALC{ch}:TRAC:DATA:MFD? '{trs}'")
+        return self._ask_trace(f":CALC{ch}:TRAC:DATA:MFD? '{trs}'")
+
+    def get_all_traces(self, traces: List[int], ch: int = 1) -> np.ndarray:
+        """Gets the formatted data of several traces of the selected channel(Ch) in a single query.
+
+        Prefer this to calling `calc_fdat` per trace.
+
+        Returns
+        -------
+        np.ndarray
+            Array of shape (len(traces), points, 2), the last axis holds the primary and secondary value.
+        """
+        return self.calc_mfd(",".join(map(str, traces)), ch).reshape(len(traces), -1, 2)
 
     def init_cont(self, status: str, ch: int = 1) -> None:
         """Turns ON/OFF the continuous initiation mode of selected channel (Ch) in the trigger system."""
-        self._instr.write(f":INIT{ch}:CONT {status}")
+        self._send(f":INIT{ch}:CONT {status}")
+
+    def trigger(self, ch: int = 1, adapt_timeout: bool = True) -> None:
+        """Starts a sweep of selected channel(Ch).
+
+        Parameters
+        ----------
+        adapt_timeout: bool
+            Raise the VISA timeout to cover the sweep time first, so reading the results does not time out
+            on slow sweeps. Costs one query; skipped inside a `batch` block, where the query would send the
+            queued commands early.
+        """
+        with self._lock:
+            if adapt_timeout and self._buffer is None:
+                self._prime_timeout(ch)
+            self._send(f":INIT{ch}")
 
-    def trigger(self, ch: int = 1) -> None:
-        self._instr.write(f":INIT{ch}")
+    @_locked
+    def _prime_timeout(self, ch: int = 1, slack: float = 2.0) -> None:
+        """Sets the VISA timeout to slack times the sweep time of selected channel(Ch), but at least `timeout`.
+
+        The slack covers sweeps that measure several stimulus ports, eg. with full 2-port correction.
+        """
+        sweep_time = self._ask_value(f":SENS{ch}:SWE:TIME?", "f")
+        self._instr.timeout = max(self._base_timeout, int(sweep_time * 1000 * slack))
 
     # Limit Test
     def limit_display(self, state: str, tr: int, ch: int = 1) -> str:
@@ -362,9 +866,9 @@ class VNA:
             ON/OFF
         """
         if state == "?":
-            return self._instr.query(f":CALC{ch}:TRAC{tr}:LIM:DISP?")
+            return self._ask_cached(f":CALC{ch}:TRAC{tr}:LIM:DISP?")
         else:
-            return self._instr.write(f":CALC{ch}:TRAC{tr}:LIM:DISP {state}")
+            return self._send(f":CALC{ch}:TRAC{tr}:LIM:DISP {state}")
 
     def limit_data(self, data: str, tr: int, ch: int = 1) -> str:
         """Sets/gets the limit table for the limit test, for the active trace of selected channel(Ch).
@@ -372,10 +876,59 @@ class VNA:
         See: https://rfmw.em.keysight.com/wireless/helpfiles/e5071c/programming/command_reference/calculate/scpi_calculate_ch_selected_limit_data.htm
         """
         if data == "?":
-            return self._instr.query(f":CALC{ch}:TRAC{tr}:LIM:DATA?")
+            return self._ask_cached(f":FORM:DATA ASC;:CALC{ch}:TRAC{tr}:LIM:DATA?", flush_input=True)
         else:
-            return self._instr.write(f":CALC{ch}:TRAC{tr}:LIM:DATA {data}")
+            return self._send(f":FORM:DATA ASC;:CALC{ch}:TRAC{tr}:LIM:DATA {data}")
 
     # IEEE4882
     def preset(self) -> None:
-        self._instr.write(":SYST:PRES")
+        self._send(":SYST:PRES")
+        self.invalidate()
+
+
+class AsyncVNA:
+    """asyncio front end of `VNA`.
+
+    Every public method of `VNA` is available as a coroutine that runs the blocking VISA call in a worker
+    thread. Calls to the same instrument are serialized by a lock, so concurrency is across instruments,
+    not within one:
+
+    >>> vna1, vna2 = await asyncio.gather(AsyncVNA.open("GPIB0::17::INSTR"), AsyncVNA.open("GPIB0::18::INSTR"))
+    >>> await asyncio.gather(vna1.calc_fdat(1), vna2.calc_fdat(1))
+
+    `batch` and `no_cache` are not wrapped, use them on the underlying `vna` inside a single call.
+    """
+
+    def __init__(self, vna: VNA) -> None:
+        """Wraps a connected `VNA`, use `open` to connect from a running event loop."""
+        self.vna = vna
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    async def open(cls, address, **kwargs) -> "AsyncVNA":
+        """Connects in a worker thread, so the VISA start-up does not block the event loop.
+
+        kwargs are passed to `VNA`.
+        """
+        return cls(await asyncio.to_thread(VNA, address, **kwargs))
+
+    async def _call(self, func, *args, **kwargs):
+        async with self._lock:
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+
+def _async_method(name: str):
+    method = getattr(VNA, name)
+
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        return await self._call(getattr(self.vna, name), *args, **kwargs)
+
+    wrapper.__qualname__ = f"AsyncVNA.{name}"
+    return wrapper
+
+
+for _name, _ in inspect.getmembers(VNA, inspect.isfunction):
+    if not _name.startswith("_") and _name not in ("batch", "no_cache"):
+        setattr(AsyncVNA, _name, _async_method(_name))
+del _name, _